@@ -4,8 +4,13 @@ And some handy classes to extend
 """
 
 import chess
+import chess.polyglot
 import logging
+import logging.handlers
+import time
 import numpy as np
+from collections import OrderedDict
+from itertools import islice
 from typing import Union
 from chess.engine import PlayResult
 from engine_wrapper import EngineWrapper
@@ -13,44 +18,107 @@ from engine_wrapper import EngineWrapper
 from bonuses import knight_bonuses, pawn_end_game_bonuses, pawn_middle_game_bonuses, \
     bishop_bonuses, rook_bonuses, queen_bonuses, king_middle_game_bonuses, king_end_game_bonuses
 
-ENGAME_LIMIT = 3915
-
-piece_mg_values: dict[int, int] = {
-    chess.PAWN: 126,
-    chess.ROOK: 1276,
-    chess.KNIGHT: 781,
-    chess.BISHOP: 825,
-    chess.QUEEN: 2536,
-    chess.KING: 20000
-}
-
-piece_eg_values: dict[int, int] = {
-    chess.PAWN: 208,
-    chess.ROOK: 1380,
-    chess.KNIGHT: 854,
-    chess.BISHOP: 915,
-    chess.QUEEN: 2682,
-    chess.KING: 20000
-}
-
-pieces_mg_bonuses: dict[int, np.ndarray[int]] = {
-    chess.PAWN: pawn_middle_game_bonuses,
-    chess.ROOK: rook_bonuses,
-    chess.KNIGHT: knight_bonuses,
-    chess.BISHOP: bishop_bonuses,
-    chess.QUEEN: queen_bonuses,
-    chess.KING: king_middle_game_bonuses
-}
-
-
-pieces_eg_bonuses: dict[int, np.ndarray[int]] = {
-    chess.PAWN: pawn_end_game_bonuses,
-    chess.ROOK: rook_bonuses,
-    chess.KNIGHT: knight_bonuses,
-    chess.BISHOP: bishop_bonuses,
-    chess.QUEEN: queen_bonuses,
-    chess.KING: king_end_game_bonuses
-}
+ENDGAME_LIMIT = 3915
+
+# Checkmate evaluation, bigger than any material difference. Depth left
+# is added to it, so the engine goes for the shortest checkmate.
+MATE_SCORE = 1_000_000
+
+# Transposition table entry flags and maximum number of stored positions
+TT_EXACT = 0
+TT_LOWERBOUND = 1
+TT_UPPERBOUND = 2
+TT_SIZE = 1_000_000
+
+# Iterative deepening limits: share of time left spent on a move,
+# maximum search depth and half-width of the aspiration window
+MOVE_TIME_SHARE = 0.05
+MAX_DEPTH = 32
+ASPIRATION_WINDOW = 100
+# Share of move time after which next iteration is not started,
+# as searching one more ply deeper would most likely run out of time
+NEXT_ITERATION_SHARE = 0.5
+
+# Maximum number of captures quiescence search goes through after depth is over
+QUIESCENCE_DEPTH = 6
+
+# Pruning: minimal depth and depth reduction for null move search,
+# margin for quiet moves to be skipped one move before the leaves
+NULL_MOVE_DEPTH = 3
+NULL_MOVE_REDUCTION = 2
+FUTILITY_MARGIN = 300
+
+# Size of log file before it is rotated and number of old log files kept
+LOG_MAX_BYTES = 1 << 20
+LOG_BACKUP_COUNT = 3
+
+# Values and bonuses are indexed by piece type, chess.PAWN to chess.KING are 1 to 6
+# and index 0 is left empty, so piece type is looked up without hashing.
+# Plain lists are used for lookup, indexing NumPy array from Python
+# is slower and gives NumPy scalars which are slower to add up.
+piece_mg_values: list[int] = [0, 126, 781, 825, 1276, 2536, 20000]
+piece_eg_values: list[int] = [0, 208, 854, 915, 1380, 2682, 20000]
+
+pieces_mg_bonuses: np.ndarray = np.array([
+    np.zeros(64, dtype=int),
+    pawn_middle_game_bonuses,
+    knight_bonuses,
+    bishop_bonuses,
+    rook_bonuses,
+    queen_bonuses,
+    king_middle_game_bonuses
+])
+
+pieces_eg_bonuses: np.ndarray = np.array([
+    np.zeros(64, dtype=int),
+    pawn_end_game_bonuses,
+    knight_bonuses,
+    bishop_bonuses,
+    rook_bonuses,
+    queen_bonuses,
+    king_end_game_bonuses
+])
+
+# Bonuses tables are written from white's side of the board,
+# so they are mirrored once here for white pieces lookup by square.
+pieces_mg_bonuses_white: list[list[int]] = pieces_mg_bonuses[:, ::-1].tolist()
+pieces_eg_bonuses_white: list[list[int]] = pieces_eg_bonuses[:, ::-1].tolist()
+pieces_mg_bonuses_black: list[list[int]] = pieces_mg_bonuses.tolist()
+pieces_eg_bonuses_black: list[list[int]] = pieces_eg_bonuses.tolist()
+
+
+_logger: Union[None, logging.Logger] = None
+
+
+def _get_logger() -> logging.Logger:
+    """Creates a logger for engine moves once and returns it for every engine instance.
+
+    Handlers are added only if logger has none, so new engines for every game
+    don't write each line multiple times. Log file is appended and rotated
+    instead of being cleared when engine is created.
+
+    Returns:
+        logging.Logger: engine moves logger
+    """
+    global _logger
+    if _logger is None:
+        logger = logging.getLogger(__name__)
+        if not logger.handlers:
+            logger.setLevel(logging.INFO)
+            formatter = logging.Formatter("%(asctime)s %(message)s")
+            file_handler = logging.handlers.RotatingFileHandler(
+                "logs/debug.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+            file_handler.setFormatter(formatter)
+            logger.addHandler(file_handler)
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(formatter)
+            logger.addHandler(console_handler)
+        _logger = logger
+    return _logger
+
+
+class SearchTimeout(Exception):
+    """Raised from negamax when time given for a move is over."""
 
 
 class FillerEngine:
@@ -104,15 +172,19 @@ class AVAChessEngine(MinimalEngine):
 
     def __init__(self, *args, name=None) -> None:
         super().__init__(*args, name=name)
-        self._clear_logs()
         # self.openning_games = self._get_openning_games()
         self.played_openning_moves = []
-        self.logger: logging.Logger = self._create_logger()
-
-    def _clear_logs(self) -> None:
-        """Cleares logs file."""
-        with open("logs/debug.log", 'w') as file:
-            pass
+        # Ordered by insertion, so the oldest entry is popped in constant time when full
+        self.tt: OrderedDict[int, tuple[int, int, float, Union[None, chess.Move]]] = OrderedDict()
+        self._eval_cache: dict[tuple[int, ...], float] = {}
+        # Left pieces values indexed by color, updated on every move made in search
+        self._material_mg: list[int] = [0, 0]
+        self._material_eg: list[int] = [0, 0]
+        self._endgame = False
+        self._deadline = float('inf')
+        self._nodes = 0
+        self._root_ply = 0
+        self.logger: logging.Logger = _get_logger()
 
     def _get_openning_games(self) -> list[list[str]]:
         """
@@ -122,24 +194,12 @@ class AVAChessEngine(MinimalEngine):
         Returns:
             list[list[str]]: sorted by first move name 6 moves opennings
         """
-        opennings = []
         with open("Games.txt", 'r') as file:
-            for line in file.readlines():
-                opennings.append([line.split()[:12]])
-        return opennings.sort(key=lambda x: x[0])
-
-    def _create_logger(self) -> logging.Logger:
-        """Creates a logger for engine moves."""
-        logger = logging.getLogger(__name__)
-        logger.setLevel(logging.INFO)
-        formatter = logging.Formatter("%(asctime)s %(message)s")
-        file_handler = logging.FileHandler("logs/debug.log")
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
-        return logger
+            lines = file.read().splitlines()
+        # Empty lines have no moves to play
+        opennings = [line.split()[:12] for line in lines if line.strip()]
+        opennings.sort(key=lambda x: x[0])
+        return opennings
 
     def _is_endgame(self, pieces_score: int) -> bool:
         """
@@ -152,51 +212,124 @@ class AVAChessEngine(MinimalEngine):
         Returns:
             bool: is this endgame for given side
         """
-        return True if pieces_score <= ENGAME_LIMIT else False
+        return True if pieces_score <= ENDGAME_LIMIT else False
 
     def _is_draw(self, board: chess.Board) -> bool:
         """
-        Checks for possible draw scenario like stalemate, 50 move rules, etc.
-        If any condition is true then the game will end in a draw.
+        Checks for possible draw scenario like insufficient material or repetition.
+        If any condition is true then the position is scored as a draw in search.
+        Stalemate is checked by negamax from generated legal moves.
+        A position repeated once is already a draw, as the side that
+        could repeat it once can repeat it again.
         """
-        return board.is_stalemate() or board.is_insufficient_material()\
-            or board.is_seventyfive_moves() or board.is_fivefold_repetition()\
-            or board.is_repetition(3)
+        # Position can only repeat after at least 4 reversible half moves,
+        # which saves walking through the move stack at most nodes
+        if board.halfmove_clock >= 4 and board.is_repetition(2):
+            return True
+        return board.is_insufficient_material()
 
-    def _calculate_pieces_values(self, board: chess.Board, color: bool,
-                                 type_of_game: dict[int, int]) -> int:
-        """Calculates left pieces values.
+    def _count_pieces(self, board: chess.Board, color: bool) -> dict[int, int]:
+        """Counts left pieces of given color, king excluded.
 
         Args:
             board (chess.Board): chess game
             color (bool): color of given pieces
-            type_of_game (dict[int, int]): endgame or middle game dict with values
+
+        Returns:
+            dict[int, int]: number of pieces by piece type
+        """
+        return {piece: chess.popcount(board.pieces_mask(piece, color))
+                for piece in chess.PIECE_TYPES if piece != chess.KING}
+
+    def _calculate_pieces_values(self, pieces_count: dict[int, int],
+                                 type_of_game: list[int]) -> int:
+        """Calculates left pieces values.
+
+        Args:
+            pieces_count (dict[int, int]): number of pieces by piece type
+            type_of_game (list[int]): endgame or middle game values by piece type
 
         Returns:
             int: sum of calculated values
         """
         pieces_score = 0
-        for piece in type_of_game:
-            if piece != chess.KING:
-                pieces_score += len(board.pieces(piece, color)) * type_of_game[piece]
+        for piece, count in pieces_count.items():
+            pieces_score += count * type_of_game[piece]
         return pieces_score
 
-    def _calculate_engine_depth(self, time_left: float) -> int:
-        """Depending on time left for move return depth for move calculation.
+    def _init_material(self, board: chess.Board) -> None:
+        """Calculates left pieces values from scratch before the search.
 
         Args:
-            time_left (float): time left for move in seconds
+            board (chess.Board): chess game board
+        """
+        for color in chess.COLORS:
+            pieces_count = self._count_pieces(board, color)
+            self._material_mg[color] = self._calculate_pieces_values(pieces_count, piece_mg_values)
+            self._material_eg[color] = self._calculate_pieces_values(pieces_count, piece_eg_values)
+        self._update_endgame()
+
+    def _update_endgame(self) -> None:
+        """Checks if it's endgame for both sides from left pieces values."""
+        self._endgame = self._is_endgame(self._material_mg[chess.WHITE]) \
+            and self._is_endgame(self._material_mg[chess.BLACK])
+
+    def _update_material(self, board: chess.Board, move: chess.Move, sign: int) -> None:
+        """Updates left pieces values with captured and promoted pieces of the move.
+        Endgame is checked again only then, as other moves don't change material.
+
+        Args:
+            board (chess.Board): chess game board before the move
+            move (chess.Move): move to be made or taken back
+            sign (int): 1 when the move is made, -1 when it is taken back
+        """
+        if not move:
+            # Null move neither captures nor promotes
+            return
+        capture = board.is_capture(move)
+        if not capture and not move.promotion:
+            return
+        if capture:
+            # En passant leaves the captured pawn off the target square
+            captured = board.piece_type_at(move.to_square) or chess.PAWN
+            self._material_mg[not board.turn] -= sign * piece_mg_values[captured]
+            self._material_eg[not board.turn] -= sign * piece_eg_values[captured]
+        if move.promotion:
+            self._material_mg[board.turn] += sign * (piece_mg_values[move.promotion]
+                                                     - piece_mg_values[chess.PAWN])
+            self._material_eg[board.turn] += sign * (piece_eg_values[move.promotion]
+                                                     - piece_eg_values[chess.PAWN])
+        self._update_endgame()
+
+    def _push(self, board: chess.Board, move: chess.Move) -> None:
+        """Makes the move on the board keeping left pieces values up to date.
+
+        Args:
+            board (chess.Board): chess game board
+            move (chess.Move): move to make
+        """
+        self._update_material(board, move, 1)
+        board.push(move)
+
+    def _pop(self, board: chess.Board) -> None:
+        """Takes back the last move on the board keeping left pieces values up to date.
+
+        Args:
+            board (chess.Board): chess game board
+        """
+        move = board.pop()
+        self._update_material(board, move, -1)
+
+    def _calculate_move_time(self, time_left: float) -> float:
+        """Depending on time left for game return time for move calculation.
+
+        Args:
+            time_left (float): time left for game in seconds
 
         Returns:
-            int: depth for future calculation
+            float: time for iterative deepening in seconds
         """
-        if time_left <= 5:
-            return 1
-        if time_left <= 15:
-            return 2
-        if time_left <= 30:
-            return 3
-        return 4
+        return time_left * MOVE_TIME_SHARE
 
     def _get_openning_move(self, move_number: int, white_move: bool) -> str:
         """Get openning move from parsed GM games. Not implemented yet."""
@@ -212,6 +345,7 @@ class AVAChessEngine(MinimalEngine):
         """
         Evaluates game position given material, placement, etc.
         If the position is > 0 - white is winning, if < 0 - black is winning.
+        Material is taken from the values kept up to date by _push and _pop.
 
         Args:
             board (chess.Board): chess game board
@@ -219,126 +353,374 @@ class AVAChessEngine(MinimalEngine):
         Returns:
             float: estimated value of the position
         """
+        # Evaluation depends only on pieces placement, which is cheaper
+        # to get from the board than zobrist hash
+        key = (board.pawns, board.knights, board.bishops, board.rooks,
+               board.queens, board.kings, board.occupied_co[chess.WHITE])
+        cached = self._eval_cache.get(key)
+        if cached is not None:
+            return cached
+
         white_material = 0
         black_material = 0
 
-        left_white_material = self._calculate_pieces_values(board, chess.WHITE, piece_mg_values)
-        left_black_material = self._calculate_pieces_values(board, chess.BLACK, piece_mg_values)
-        endgame = self._is_endgame(left_white_material) and self._is_endgame(left_black_material)
+        endgame = self._endgame
 
         if (endgame):
-            white_material += self._calculate_pieces_values(board, chess.WHITE, piece_eg_values)
-            black_material += self._calculate_pieces_values(board, chess.BLACK, piece_eg_values)
+            white_material += self._material_eg[chess.WHITE]
+            black_material += self._material_eg[chess.BLACK]
         else:
-            white_material += left_white_material
-            black_material += left_black_material
+            white_material += self._material_mg[chess.WHITE]
+            black_material += self._material_mg[chess.BLACK]
 
         # Add evaluation from bonuses depending on a square the piece is standing
-        for square in chess.SQUARES:
-            piece = board.piece_at(square)
-            if not piece:
-                continue
-            if piece.color == chess.WHITE:
-                if endgame:
-                    white_material += pieces_eg_bonuses[piece.piece_type][::-1][square]
-                else:
-                    white_material += pieces_mg_bonuses[piece.piece_type][::-1][square]
-            else:
-                if endgame:
-                    black_material += pieces_eg_bonuses[piece.piece_type][square]
-                else:
-                    black_material += pieces_mg_bonuses[piece.piece_type][square]
-        return white_material - black_material
+        # going only through occupied squares of each piece bitboard
+        if endgame:
+            white_bonuses, black_bonuses = pieces_eg_bonuses_white, pieces_eg_bonuses_black
+        else:
+            white_bonuses, black_bonuses = pieces_mg_bonuses_white, pieces_mg_bonuses_black
+        # Lowest set bit is taken off the bitboard until it is empty
+        for piece_type in chess.PIECE_TYPES:
+            piece_bonuses = white_bonuses[piece_type]
+            bitboard = board.pieces_mask(piece_type, chess.WHITE)
+            while bitboard:
+                white_material += piece_bonuses[(bitboard & -bitboard).bit_length() - 1]
+                bitboard &= bitboard - 1
+            piece_bonuses = black_bonuses[piece_type]
+            bitboard = board.pieces_mask(piece_type, chess.BLACK)
+            while bitboard:
+                black_material += piece_bonuses[(bitboard & -bitboard).bit_length() - 1]
+                bitboard &= bitboard - 1
+
+        evaluation = white_material - black_material
+        self._eval_cache[key] = evaluation
+        return evaluation
+
+    def _mvv_lva(self, board: chess.Board, move: chess.Move) -> tuple[int, int]:
+        """
+        Scores capture or promotion by Most Valuable Victim - Least Valuable Attacker.
+        Material won by the move, captured piece and promotion, is compared first,
+        attacker value only breaks ties between the same victims.
+
+        Args:
+            board (chess.Board): chess game board
+            move (chess.Move): capture or promotion move
+
+        Returns:
+            tuple[int, int]: move score, the higher the earlier move is searched
+        """
+        victim_value = 0
+        attacker_value = 0
+        if move.promotion:
+            victim_value += piece_mg_values[move.promotion] - piece_mg_values[chess.PAWN]
+        if board.is_capture(move):
+            # En passant leaves the captured pawn off the target square
+            victim = board.piece_type_at(move.to_square) or chess.PAWN
+            victim_value += piece_mg_values[victim]
+            attacker_value = piece_mg_values[board.piece_type_at(move.from_square)]
+        return victim_value, -attacker_value
+
+    def _check_squares(self, board: chess.Board) -> dict[int, int]:
+        """
+        Finds squares from which each piece type of the side to move checks opponent king.
+        Lets move ordering find checks from bitboards without making the moves,
+        discovered checks are not looked for.
+
+        Args:
+            board (chess.Board): chess game board
+
+        Returns:
+            dict[int, int]: bitboard of checking squares by piece type
+        """
+        king = board.king(not board.turn)
+        occupied = board.occupied
+        diagonal = chess.BB_DIAG_ATTACKS[king][chess.BB_DIAG_MASKS[king] & occupied]
+        straight = chess.BB_RANK_ATTACKS[king][chess.BB_RANK_MASKS[king] & occupied] \
+            | chess.BB_FILE_ATTACKS[king][chess.BB_FILE_MASKS[king] & occupied]
+        return {
+            chess.PAWN: chess.BB_PAWN_ATTACKS[not board.turn][king],
+            chess.KNIGHT: chess.BB_KNIGHT_ATTACKS[king],
+            chess.BISHOP: diagonal,
+            chess.ROOK: straight,
+            chess.QUEEN: diagonal | straight,
+            chess.KING: chess.BB_EMPTY
+        }
 
-    def _sort_moves(self, board: chess.Board) -> np.ndarray[chess.Move]:
+    def _sort_moves(self, board: chess.Board, tt_move: Union[None, chess.Move] = None,
+                    moves: Union[None, list[chess.Move]] = None) -> list[chess.Move]:
         """
         Sort legal moves in the position with custom order.
-        Following checks, captures, attack principle. 
+        Following transposition table move, captures, checks, attack principle.
+        Captures and promotions are ordered by MVV-LVA.
 
         Args:
             board (chess.Board): chess game board
+            tt_move (Union[None, chess.Move]): best move stored in transposition table
+            moves (Union[None, list[chess.Move]]): already generated legal moves
 
         Returns:
-            np.ndarray[chess.Move]: sorted array of all legal moves
+            list[chess.Move]: sorted list of all legal moves
         """
-        captures, checks, others = [], [], []
-        for move in board.legal_moves:
-            if board.is_capture(move):
+        check_squares = self._check_squares(board)
+        first, captures, checks, others = [], [], [], []
+        for move in board.legal_moves if moves is None else moves:
+            if move == tt_move:
+                first.append(move)
+            elif board.is_capture(move) or move.promotion:
                 captures.append(move)
+            elif chess.BB_SQUARES[move.to_square] \
+                    & check_squares[board.piece_type_at(move.from_square)]:
+                checks.append(move)
             else:
-                board.push(move)
-                if board.is_check:
-                    checks.append(move)
-                else:
-                    others.append(move)
-                board.pop()
+                others.append(move)
 
-        np_captures = np.array(captures)
-        np_checks = np.array(checks)
-        np_others = np.array(others)
-        return np.concatenate((np_captures, np_checks, np_others))
+        captures.sort(key=lambda move: self._mvv_lva(board, move), reverse=True)
+        return first + captures + checks + others
 
-    def minimax(self, board: chess.Board, depth: int, alpha: float, beta: float,
-                white_move: bool) -> tuple[Union[None, chess.Move], float]:
-        """Minimax Algorithm to determine the best move in the position.
+    def _store_tt(self, key: int, depth: int, flag: int, value: float,
+                  best_move: Union[None, chess.Move]) -> None:
+        """Stores position in transposition table, evicting the oldest entry when full.
 
-        A minimax algorithm. Recursively goes through tree of legal moves evaluating the position to
-        determine the best next move. Using Alpha-Beta Pruning it cuts off branches in the game tree
-        which need not be searched because there already exists a better move available.
+        Entry of the same position searched to a bigger depth is kept,
+        as it is more precise than the new one.
+
+        Args:
+            key (int): zobrist hash of the position
+            depth (int): depth the position was searched to
+            flag (int): TT_EXACT, TT_LOWERBOUND or TT_UPPERBOUND
+            value (float): position evaluation
+            best_move (Union[None, chess.Move]): best move found in the position
+        """
+        entry = self.tt.get(key)
+        if entry:
+            if entry[0] > depth:
+                return
+        elif len(self.tt) >= TT_SIZE:
+            self.tt.popitem(last=False)
+        self.tt[key] = (depth, flag, value, best_move)
+
+    def _tt_flag(self, value: float, alpha: float, beta: float) -> int:
+        """Classifies search result against the original alpha-beta window.
+
+        Args:
+            value (float): position evaluation
+            alpha (float): alpha before searching the position
+            beta (float): beta before searching the position
+
+        Returns:
+            int: transposition table flag
+        """
+        if value <= alpha:
+            return TT_UPPERBOUND
+        if value >= beta:
+            return TT_LOWERBOUND
+        return TT_EXACT
+
+    def _count_node(self) -> None:
+        """Counts searched node and checks time once per 256 nodes.
+
+        Raises:
+            SearchTimeout: time given for a move is over
+        """
+        self._nodes += 1
+        if not self._nodes % 256 and time.perf_counter() > self._deadline:
+            raise SearchTimeout()
+
+    def _quiesce(self, board: chess.Board, alpha: float, beta: float,
+                 color: int, depth: int) -> float:
+        """Quiescence search to evaluate only quiet positions.
+
+        Extends search at the leaves with captures until there are none left,
+        so the position is not evaluated in the middle of a capture exchange.
+        Side to move can stand pat with the static evaluation instead of capturing,
+        unless it is in check, then all evasions are searched to see checkmates.
+
+        Args:
+            board (chess.Board): chess game board
+            alpha (float): best choice found so far
+            beta (float): lowest choice found so far
+            color (int): 1 if white to move, -1 if black
+            depth (int): captures left to search
+
+        Returns:
+            float: position evaluation from the side to move point of view
+        """
+        self._count_node()
+
+        if not depth:
+            return color * self.evaluate_position(board)
+
+        if board.is_check():
+            moves = list(board.generate_legal_moves())
+            if not moves:
+                return -MATE_SCORE
+            best_position = -float('inf')
+        else:
+            stand_pat = color * self.evaluate_position(board)
+            if stand_pat >= beta:
+                return stand_pat
+            moves = list(board.generate_legal_captures())
+            best_position = stand_pat
+            alpha = max(alpha, stand_pat)
+
+        moves.sort(key=lambda move: self._mvv_lva(board, move), reverse=True)
+        for move in moves:
+            self._push(board, move)
+            current_position = -self._quiesce(board, -beta, -alpha, -color, depth - 1)
+            self._pop(board)
+            best_position = max(best_position, current_position)
+            alpha = max(alpha, current_position)
+            if beta <= alpha:
+                break
+        return best_position
+
+    def _next_moves(self, board: chess.Board, depth: int) -> list[chess.Move]:
+        """Generates legal moves in the position after a move was pushed.
+
+        Legal moves are generated once and passed down to the next node
+        when it is going to sort them, otherwise only the first legal move
+        is generated to tell checkmate and stalemate apart.
+
+        Args:
+            board (chess.Board): chess game board
+            depth (int): depth left for the position
+
+        Returns:
+            list[chess.Move]: legal moves, empty if there are none
+        """
+        if depth:
+            return list(board.generate_legal_moves())
+        return list(islice(board.generate_legal_moves(), 1))
+
+    def negamax(self, board: chess.Board, depth: int, alpha: float, beta: float,
+                color: int, moves: Union[None, list[chess.Move]] = None
+                ) -> tuple[Union[None, chess.Move], float]:
+        """Negamax Algorithm to determine the best move in the position.
+
+        A minimax algorithm in negamax form. Recursively goes through tree of legal moves evaluating
+        the position to determine the best next move. Position is evaluated from the side to move
+        point of view, so both sides maximize negated evaluation of the position after their move.
+        Using Alpha-Beta Pruning it cuts off branches in the game tree which need not be searched
+        because there already exists a better move available.
 
         Args:
             board (chess.Board): chess game board
             depth (int): depth of move calculation
             alpha (float): best choice found so far
             beta (float): lowest choice found so far
-            white_move (bool): white or black to move
+            color (int): 1 if white to move, -1 if black
+            moves (Union[None, list[chess.Move]]): legal moves if already generated by parent node
 
         Returns:
             tuple[Union[None, chess.Move], float]: best move and position evaluation
+                from the side to move point of view
         """
+        self._count_node()
+
         best_move = None
+        tt_move = None
+        alpha_orig, beta_orig = alpha, beta
+
+        # Leaves are not stored in transposition table, so they are not hashed either
+        if not depth:
+            return None, self._quiesce(board, alpha, beta, color, QUIESCENCE_DEPTH)
+
+        key = chess.polyglot.zobrist_hash(board)
+        entry = self.tt.get(key)
+        if entry:
+            tt_depth, flag, value, tt_move = entry
+            if tt_depth >= depth:
+                if flag == TT_EXACT:
+                    return tt_move, value
+                if flag == TT_LOWERBOUND:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return tt_move, value
+
+        # Checkmate and draws are detected right after the move is pushed,
+        # so here only a position without legal moves has to be handled
+        sorted_moves = self._sort_moves(board, tt_move, moves)
+        in_check = board.is_check()
+        if not sorted_moves:
+            return None, -MATE_SCORE - depth if in_check else 0
+
+        # Null move pruning: if position is still too good for the opponent after
+        # passing the move, searched with reduced depth, skip it. Not used at the root,
+        # twice in a row and without pieces other than pawns where passing can be better.
+        if depth >= NULL_MOVE_DEPTH and not in_check and board.ply() > self._root_ply \
+                and board.peek() and board.occupied_co[board.turn] & ~(board.pawns | board.kings):
+            self._push(board, chess.Move.null())
+            _, null_position = self.negamax(board, depth - 1 - NULL_MOVE_REDUCTION,
+                                            -beta, -beta + 1, -color)
+            self._pop(board)
+            if -null_position >= beta:
+                return None, beta
+
+        # Futility pruning: one move before the leaves quiet moves can't raise position
+        # evaluation by more than a margin, so they are skipped if alpha is out of reach.
+        # Checks are found from bitboards as in move ordering, without making the moves.
+        futility_limit = float('inf')
+        if depth == 1 and not in_check:
+            futility_limit = color * self.evaluate_position(board) + FUTILITY_MARGIN
+            check_squares = self._check_squares(board)
+
+        best_position = -float('inf')
+        for move in sorted_moves:
+            if futility_limit <= alpha and not board.is_capture(move) and not move.promotion \
+                    and not chess.BB_SQUARES[move.to_square] \
+                    & check_squares[board.piece_type_at(move.from_square)]:
+                best_position = max(best_position, futility_limit)
+                continue
+            self._push(board, move)
+            next_moves = self._next_moves(board, depth - 1)
+            if not next_moves:
+                current_position = MATE_SCORE + depth - 1 if board.is_check() else 0
+            elif self._is_draw(board):
+                current_position = 0
+            else:
+                _, current_position = self.negamax(board, depth - 1, -beta, -alpha, -color,
+                                                   next_moves)
+                current_position = -current_position
+            self._pop(board)
+            # Pruned moves only raise the bound, best move is the best searched one
+            if current_position > best_position:
+                best_move = move
+                best_position = current_position
+            elif best_move is None:
+                best_move = move
+            alpha = max(alpha, current_position)
+            if beta <= alpha:
+                break
+        self._store_tt(key, depth, self._tt_flag(best_position, alpha_orig, beta_orig),
+                       best_position, best_move)
+        return best_move, best_position
+
+    def _aspiration_search(self, board: chess.Board, depth: int, guess: float,
+                           color: int) -> tuple[Union[None, chess.Move], float]:
+        """Searches the root in a narrow window around previous iteration score.
+
+        If the score falls outside of the window the position is searched again
+        with the full window.
 
-        if not depth or board.is_game_over():
-            return None, self.evaluate_position(board)
+        Args:
+            board (chess.Board): chess game board
+            depth (int): depth of move calculation
+            guess (float): evaluation from previous iteration
+            color (int): 1 if white to move, -1 if black
 
-        sorted_moves = self._sort_moves(board)
+        Returns:
+            tuple[Union[None, chess.Move], float]: best move and position evaluation
+        """
+        if depth == 1 or abs(guess) >= MATE_SCORE:
+            return self.negamax(board, depth, -float('inf'), float('inf'), color)
 
-        if white_move:
-            best_position = -float('inf')
-            for move in sorted_moves:
-                board.push(move)
-                if board.is_checkmate():
-                    current_position = float('inf')
-                elif self._is_draw(board):
-                    current_position = 0
-                else:
-                    _, current_position = self.minimax(board, depth - 1, alpha, beta, False)
-                board.pop()
-                if current_position > best_position:
-                    best_move = move
-                    best_position = current_position
-                alpha = max(alpha, current_position)
-                if beta <= alpha:
-                    break
-            return best_move, best_position
-        else:
-            best_position = float('inf')
-            for move in sorted_moves:
-                board.push(move)
-                if board.is_checkmate():
-                    current_position = -float('inf')
-                elif self._is_draw(board):
-                    current_position = 0
-                else:
-                    _, current_position = self.minimax(board, depth - 1, alpha, beta, True)
-                board.pop()
-                if current_position < best_position:
-                    best_move = move
-                    best_position = current_position
-                beta = min(beta, current_position)
-                if beta <= alpha:
-                    break
-            return best_move, best_position
+        alpha, beta = guess - ASPIRATION_WINDOW, guess + ASPIRATION_WINDOW
+        best_move, score = self.negamax(board, depth, alpha, beta, color)
+        if score <= alpha or score >= beta:
+            best_move, score = self.negamax(board, depth, -float('inf'), float('inf'), color)
+        return best_move, score
 
     def search(self, board: chess.Board, timeLeft: Union[chess.engine.Limit, int], *args) -> PlayResult:
         """Starting point for chess engine required by lichess-bot.
@@ -369,23 +751,48 @@ class AVAChessEngine(MinimalEngine):
         Returns:
             chess.Move: best move in a position
         """
-        depth = 4
+        max_depth = 4
+        self._deadline = float('inf')
+        deadline = float('inf')
+        soft_deadline = float('inf')
+        self._eval_cache.clear()
+        self._init_material(board)
 
         if isinstance(time_left, int):
             # Checking if first call, which returns time control as chess.engine.Limit
-            depth = self._calculate_engine_depth(time_left / 1000)
+            max_depth = MAX_DEPTH
+            move_time = self._calculate_move_time(time_left / 1000)
+            start = time.perf_counter()
+            deadline = start + move_time
+            soft_deadline = start + move_time * NEXT_ITERATION_SHARE
 
-        if board.turn == chess.WHITE:
-            best_move, _ = self.minimax(board, depth, -float('inf'), +float('inf'), white_move=True)
-        else:
-            best_move, _ = self.minimax(board, depth, -float('inf'), +float('inf'), white_move=False)
+        best_move = None
+        depth = 0
+        score = 0.0
+        color = 1 if board.turn == chess.WHITE else -1
+        self._root_ply = board.ply()
+        for current_depth in range(1, max_depth + 1):
+            try:
+                move, score = self._aspiration_search(board, current_depth, score, color)
+            except SearchTimeout:
+                # Take back moves left on the board by the interrupted search
+                while board.ply() > self._root_ply:
+                    self._pop(board)
+                break
+            if move:
+                best_move, depth = move, current_depth
+            # Depth 1 is always searched to the end, so there is a searched move
+            # even when there is almost no time left, later iterations can be stopped
+            self._deadline = deadline
+            if abs(score) >= MATE_SCORE or time.perf_counter() > soft_deadline:
+                break
 
         self.logger.info(f"Depth {depth} Best move: {best_move} Move number: {board.fullmove_number}")
-        self.logger.info(f"Engine evaluation: {self.evaluate_position(board) / 1000}")
+        # Score of the last completed search, from white's point of view
+        self.logger.info(f"Engine evaluation: {color * score / 1000}")
 
-        # if for some reason minimax does not proive a move
-        # take random one from legal moves that are available
+        # if for some reason negamax does not proive a move
+        # take first one from legal moves that are available
         if not best_move:
-            for move in board.legal_moves:
-                return move
+            return next(iter(board.legal_moves), None)
         return best_move